@@ -1,51 +1,319 @@
 # file_loader.py
+import hashlib
 import io
+import mmap
+import os
+import tempfile
+import threading
+import time
 import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import pandas as pd
+import pypdfium2 as pdfium
 from PyPDF2 import PdfReader
 from docx import Document
+from lxml import etree
+
+class _MmapReader(io.RawIOBase):
+    """Seekable read-only file over an mmap, without copying it into memory."""
+
+    def __init__(self, m: mmap.mmap):
+        self._m = m
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buf):
+        data = self._m.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self._m.seek(offset, whence)
+        return self._m.tell()
+
+    def tell(self):
+        return self._m.tell()
+
+def _as_stream(b):
+    # BytesIO shares a bytes buffer; an mmap gets a reader so it is paged
+    # in on demand rather than copied
+    if isinstance(b, mmap.mmap):
+        b.seek(0)
+        return _MmapReader(b)
+    return io.BytesIO(b)
+
+_W_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_W_P, _W_T, _W_TAB, _W_BR = _W_NS + "p", _W_NS + "t", _W_NS + "tab", _W_NS + "br"
+# mc:AlternateContent repeats a textbox in mc:Fallback for older readers
+_MC_FALLBACK = "{http://schemas.openxmlformats.org/markup-compatibility/2006}Fallback"
+
+# below this page count the process pool start-up costs more than it saves
+PDF_PARALLEL_MIN_PAGES = 8
+# how many levels of zip-inside-zip get_raw_text will unpack
+MAX_ZIP_DEPTH = 3
+
+# raw text cache eviction: entries unused this long, then oldest over the cap
+RAW_TEXT_CACHE_TTL = 30 * 24 * 3600
+RAW_TEXT_CACHE_MAX_ENTRIES = 256
+
+# one process pool for every PDF, however many threads extract at once, so
+# the process count stays at cpu_count rather than cpu_count per file
+_pdf_pool = None
+_pdf_pool_lock = threading.Lock()
+
+def _get_pdf_pool() -> ProcessPoolExecutor:
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            _pdf_pool = ProcessPoolExecutor(max_workers=os.cpu_count() or 1)
+        return _pdf_pool
+
+def _reset_pdf_pool(pool: ProcessPoolExecutor):
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is pool:
+            _pdf_pool = None
+    pool.shutdown(wait=False)
+
+def _extract_pdf_pages(pdf, page_indices) -> str:
+    parts = []
+    for i in page_indices:
+        page = pdf[i]
+        textpage = page.get_textpage()
+        parts.append(textpage.get_text_range())
+        textpage.close()
+        page.close()
+    return "".join(parts)
+
+def _extract_pdf_page_range(task) -> str:
+    path, start, stop = task
+    pdf = pdfium.PdfDocument(path)
+    try:
+        return _extract_pdf_pages(pdf, range(start, stop))
+    finally:
+        pdf.close()
+
+def _extract_text_from_pdf_pypdf2(b: bytes) -> str:
+    pdf = PdfReader(_as_stream(b))
+    return "".join(page.extract_text() or "" for page in pdf.pages)
 
 def extract_text_from_pdf_bytes(b: bytes) -> str:
-    text = ""
-    pdf = PdfReader(io.BytesIO(b))
-    for page in pdf.pages:
-        text += page.extract_text() or ""
-    return text
+    try:
+        pdf = pdfium.PdfDocument(b if isinstance(b, bytes) else _as_stream(b))
+    except pdfium.PdfiumError:
+        # PDFium refuses some encrypted files; PyPDF2 can still read those
+        return _extract_text_from_pdf_pypdf2(b)
+    try:
+        n_pages = len(pdf)
+        n_workers = min(os.cpu_count() or 1, n_pages)
+        if n_pages < PDF_PARALLEL_MIN_PAGES or n_workers < 2:
+            return _extract_pdf_pages(pdf, range(n_pages))
+    finally:
+        pdf.close()
+
+    # workers open the PDF from a temp file rather than each being sent the bytes
+    fd, path = tempfile.mkstemp(suffix=".pdf")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(b)
+        # split pages into one contiguous range per worker, keeping page order
+        step = -(-n_pages // n_workers)
+        tasks = [(path, start, min(start + step, n_pages)) for start in range(0, n_pages, step)]
+        pool = _get_pdf_pool()
+        try:
+            return "".join(pool.map(_extract_pdf_page_range, tasks))
+        except BrokenProcessPool:
+            # a worker died; start a fresh pool next time and finish this file here
+            _reset_pdf_pool(pool)
+            return "".join(_extract_pdf_page_range(task) for task in tasks)
+    finally:
+        os.remove(path)
+
+def _extract_text_from_docx_xml(b: bytes) -> str:
+    # stream word/document.xml instead of building python-docx's object tree.
+    # Every w:p is read, so table cells and textboxes are included; the
+    # mc:Fallback copy of a textbox is skipped so its text is not doubled
+    paragraphs = []
+    runs = []
+    fallback_depth = 0
+    with zipfile.ZipFile(_as_stream(b)) as z, z.open("word/document.xml") as f:
+        for event, el in etree.iterparse(f, events=("start", "end"), tag=(_W_T, _W_TAB, _W_BR, _W_P, _MC_FALLBACK)):
+            if el.tag == _MC_FALLBACK:
+                fallback_depth += 1 if event == "start" else -1
+                if event == "end":
+                    el.clear()
+            elif event == "start" or fallback_depth:
+                continue
+            elif el.tag == _W_T:
+                runs.append(el.text or "")
+            elif el.tag == _W_TAB:
+                runs.append("\t")
+            elif el.tag == _W_BR:
+                runs.append("\n")
+            else:
+                paragraphs.append("".join(runs))
+                runs = []
+                el.clear()
+    return "\n".join(paragraphs)
 
 def extract_text_from_docx_bytes(b: bytes) -> str:
-    doc = Document(io.BytesIO(b))
-    return "\n".join([p.text for p in doc.paragraphs])
+    try:
+        return _extract_text_from_docx_xml(b)
+    except (KeyError, zipfile.BadZipFile, etree.XMLSyntaxError):
+        # unusual package layout: let python-docx resolve the main part
+        doc = Document(_as_stream(b))
+        return "\n".join([p.text for p in doc.paragraphs])
+
+def _read_excel(b: bytes) -> pd.DataFrame:
+    try:
+        return pd.read_excel(_as_stream(b), engine="calamine")
+    except (ImportError, ValueError):
+        # python-calamine missing or pandas < 2.2: pandas' default engine
+        # (openpyxl already opens workbooks read_only / data_only)
+        return pd.read_excel(_as_stream(b))
 
 def extract_text_from_excel_bytes(b: bytes) -> str:
-    df = pd.read_excel(io.BytesIO(b))
-    text = ""
-    for i, row in df.iterrows():
-        row_text = " | ".join(f"{col}: {row[col]}" for col in df.columns)
-        text += f"Row {i+1}: {row_text}\n"
-    return text
+    df = _read_excel(b)
+    if df.empty:
+        return ""
+    # build "col: val | col: val" for all rows at once, one column at a time
+    row_text = None
+    for col in df.columns:
+        # pandas 3 keeps missing values as NaN through astype(str)
+        cells = f"{col}: " + df[col].astype(str).fillna("nan")
+        row_text = cells if row_text is None else row_text + " | " + cells
+    row_numbers = pd.Series(df.index + 1, index=df.index).astype(str)
+    return "".join("Row " + row_numbers + ": " + row_text + "\n")
 
-def extract_text_from_zip_bytes(b: bytes) -> str:
-    text = ""
-    with zipfile.ZipFile(io.BytesIO(b)) as z:
-        for filename in z.namelist():
-            with z.open(filename) as f:
-                inner = f.read()
-                text += get_raw_text(inner, filename) + "\n\n"
-    return text
+def extract_text_from_zip_bytes(b: bytes, depth: int = 0) -> str:
+    if depth >= MAX_ZIP_DEPTH:
+        # nested archives this deep are almost always zip bombs
+        return ""
+    with zipfile.ZipFile(_as_stream(b)) as z:
+        def extract(info):
+            # each worker decompresses its own member, so only the entries
+            # being parsed are in memory, not the whole unpacked archive
+            return get_raw_text(z.read(info), info.filename, depth=depth + 1)
+
+        # ex.map keeps archive order
+        members = [info for info in z.infolist() if not info.is_dir()]
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+            return "".join(text + "\n\n" for text in ex.map(extract, members))
+
+def _extract_plain_text(b) -> str:
+    # fallback: try to decode as text
+    try:
+        return str(b, "utf-8", errors="ignore")
+    except Exception:
+        return ""
+
+# kind -> extractor(file_bytes, depth)
+_HANDLERS = {
+    "pdf": lambda b, depth: extract_text_from_pdf_bytes(b),
+    "docx": lambda b, depth: extract_text_from_docx_bytes(b),
+    "excel": lambda b, depth: extract_text_from_excel_bytes(b),
+    "zip": lambda b, depth: extract_text_from_zip_bytes(b, depth=depth),
+    "text": lambda b, depth: _extract_plain_text(b),
+}
+_EXTENSION_KINDS = {".pdf": "pdf", ".docx": "docx", ".xlsx": "excel", ".xls": "excel", ".zip": "zip"}
 
-def get_raw_text(file_bytes: bytes, filename: str) -> str:
-    filename = filename.lower()
-    if filename.endswith(".pdf"):
-        return extract_text_from_pdf_bytes(file_bytes)
-    elif filename.endswith(".docx"):
-        return extract_text_from_docx_bytes(file_bytes)
-    elif filename.endswith((".xlsx", ".xls")):
-        return extract_text_from_excel_bytes(file_bytes)
-    elif filename.endswith(".zip"):
-        return extract_text_from_zip_bytes(file_bytes)
-    else:
-        # fallback: try to decode as text
+def _sniff_kind(file_bytes, ext: str) -> str:
+    """Classify a file by its leading bytes, so misnamed files reach the right parser."""
+    head = bytes(file_bytes[:1024])
+    if head.startswith(b"%PDF") or (ext == ".pdf" and b"%PDF" in head):
+        # readers accept the header anywhere in the first 1 KB
+        return "pdf"
+    if head.startswith(b"PK\x03\x04"):
+        # OOXML documents are zips too; the central directory tells them apart
         try:
-            return file_bytes.decode("utf-8", errors="ignore")
-        except Exception:
-            return ""
+            with zipfile.ZipFile(_as_stream(file_bytes)) as z:
+                names = set(z.namelist())
+        except zipfile.BadZipFile:
+            return _EXTENSION_KINDS.get(ext, "text")
+        if "word/document.xml" in names:
+            return "docx"
+        if "xl/workbook.xml" in names:
+            return "excel"
+        return "zip"
+    if head.startswith(b"\xd0\xcf\x11\xe0"):
+        # OLE2 container: only legacy .xls is parsed, .doc etc. stay text
+        return "excel" if ext == ".xls" else "text"
+    # no binary signature: whatever the extension claims, it is not a
+    # PDF/OOXML/zip/xls, so do not start a parse that is bound to fail
+    return "text"
+
+def get_raw_text(file_bytes: bytes, filename: str, depth: int = 0) -> str:
+    """
+    Extract text from a file, dispatching on its magic bytes and falling
+    back to the extension.
+    """
+    ext = os.path.splitext(filename.lower())[1]
+    return _HANDLERS[_sniff_kind(file_bytes, ext)](file_bytes, depth)
+
+
+def get_raw_text_from_file(f, filename: str) -> str:
+    """
+    get_raw_text for an open binary file. Files backed by disk are parsed
+    through a read-only mmap instead of being read into memory.
+    """
+    f.seek(0)
+    # a SpooledTemporaryFile still in memory would be forced to disk by fileno()
+    if isinstance(f, tempfile.SpooledTemporaryFile) and not f._rolled:
+        return get_raw_text(f.read(), filename)
+    try:
+        fileno = f.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        return get_raw_text(f.read(), filename)
+    if os.fstat(fileno).st_size == 0:
+        return get_raw_text(b"", filename)
+    with mmap.mmap(fileno, 0, access=mmap.ACCESS_READ) as m:
+        return get_raw_text(m, filename)
+
+# ----------------------- RAW TEXT CACHE -----------------------
+def _evict_raw_text_cache(cache_dir: str):
+    entries = []
+    for name in os.listdir(cache_dir):
+        if not name.endswith(".txt"):
+            continue
+        path = os.path.join(cache_dir, name)
+        try:
+            entries.append((os.path.getatime(path), path))
+        except OSError:
+            continue
+    entries.sort(reverse=True)
+    cutoff = time.time() - RAW_TEXT_CACHE_TTL
+    for i, (atime, path) in enumerate(entries):
+        if i >= RAW_TEXT_CACHE_MAX_ENTRIES or atime < cutoff:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+def get_raw_text_cached(file_bytes: bytes, filename: str, cache_dir: str) -> str:
+    """
+    Same as get_raw_text, but keyed by the SHA-256 of the file bytes so a
+    re-upload of the same file skips parsing. Entries live in cache_dir as
+    <sha256><ext>.txt and are evicted least-recently-used.
+    """
+    ext = os.path.splitext(filename)[1].lower()
+    path = os.path.join(cache_dir, hashlib.sha256(file_bytes).hexdigest() + ext + ".txt")
+    if os.path.isfile(path):
+        with open(path, encoding="utf-8") as f:
+            text = f.read()
+        os.utime(path)  # atime is unreliable on relatime mounts
+        return text
+
+    text = get_raw_text(file_bytes, filename)
+    os.makedirs(cache_dir, exist_ok=True)
+    # unique temp name: concurrent downloads of the same file may race here
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+    _evict_raw_text_cache(cache_dir)
+    return text
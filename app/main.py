@@ -1,32 +1,141 @@
 import streamlit as st
 import os
-import io
 import requests
 import base64
+import hashlib
+import mmap
+import shutil
+import tempfile
 import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+import orjson
+from requests.adapters import HTTPAdapter
 from urllib.parse import urlparse
 from dotenv import load_dotenv
 
 # local modules
-from file_loader import get_raw_text
-from qa_engine import build_qa_engine, save_vectorstore, load_vectorstore
+from file_loader import get_raw_text_cached
+from qa_engine import build_qa_engine, save_vectorstore, load_vectorstore, QueryCache
+
+# ---------------- Streamlit UI Init ----------------
+# first Streamlit command: cached calls below count as commands on older releases
+st.set_page_config(page_title="Doc Chatbot", layout="wide")
 
 # ---------------- Load Environment ----------------
-dotenv_path = os.path.join(os.path.dirname(__file__), ".env")
-load_dotenv(dotenv_path=dotenv_path)
+@st.cache_resource
+def load_env() -> dict:
+    # read .env once per process, not on every rerun
+    dotenv_path = os.path.join(os.path.dirname(__file__), ".env")
+    load_dotenv(dotenv_path=dotenv_path)
+    keys = ["OPENAI_API_KEY", "OPENAI_API_BASE", "TENANT_ID", "CLIENT_ID", "CLIENT_SECRET"]
+    return {key: os.getenv(key) for key in keys}
 
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-OPENAI_API_BASE = os.getenv("OPENAI_API_BASE")
-TENANT_ID = os.getenv("TENANT_ID")
-CLIENT_ID = os.getenv("CLIENT_ID")
-CLIENT_SECRET = os.getenv("CLIENT_SECRET")
+env = load_env()
+OPENAI_API_KEY = env["OPENAI_API_KEY"]
+OPENAI_API_BASE = env["OPENAI_API_BASE"]
+TENANT_ID = env["TENANT_ID"]
+CLIENT_ID = env["CLIENT_ID"]
+CLIENT_SECRET = env["CLIENT_SECRET"]
 
 # ---------------- Persistence ----------------
 PERSIST_DIR = os.path.join(os.path.dirname(__file__), "persisted_data")
 os.makedirs(PERSIST_DIR, exist_ok=True)
+RAW_TEXT_CACHE_DIR = os.path.join(PERSIST_DIR, "raw_text_cache")
+# uploads are stored once under their content hash; cache names link to them
+VECTORSTORE_HASH_DIR = os.path.join(PERSIST_DIR, "by_hash")
+INTERNAL_DIRS = {os.path.basename(RAW_TEXT_CACHE_DIR), os.path.basename(VECTORSTORE_HASH_DIR)}
+# seconds the knowledge-base list may lag saves made by other processes
+LIST_CACHES_TTL = 30
 
-# ---------------- Streamlit UI Init ----------------
-st.set_page_config(page_title="Doc Chatbot", layout="wide")
+
+@st.cache_data(ttl=LIST_CACHES_TTL)
+def list_caches() -> list:
+    # cleared whenever this process saves a cache, so reruns do not rescan
+    # PERSIST_DIR; the ttl picks up ones other processes saved
+    return [d for d in os.listdir(PERSIST_DIR)
+            if os.path.isdir(os.path.join(PERSIST_DIR, d)) and d not in INTERNAL_DIRS]
+
+
+def cache_name_error(cache_name: str):
+    """Why cache_name cannot name an entry directly under PERSIST_DIR, or None if it can."""
+    if not cache_name or cache_name in (".", ".."):
+        return "Cache name must not be empty, '.' or '..'."
+    if "/" in cache_name or "\\" in cache_name or (os.altsep and os.altsep in cache_name):
+        return "Cache name must not contain path separators."
+    if cache_name in INTERNAL_DIRS:
+        return f"'{cache_name}' is reserved."
+    return None
+
+
+def text_digest(text: str) -> str:
+    """Content hash for knowledge bases built from extracted text (SharePoint loads)."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def link_cache_name(cache_name: str, digest: str):
+    """Point PERSIST_DIR/<cache_name> at the vectorstore stored under its content hash."""
+    error = cache_name_error(cache_name)
+    if error:
+        raise ValueError(error)
+    link = os.path.join(PERSIST_DIR, cache_name)
+    target = os.path.join(VECTORSTORE_HASH_DIR, digest)
+    if os.path.islink(link):
+        os.remove(link)
+    elif os.path.lexists(link):
+        # only links are replaced; a real directory may be someone's only copy
+        raise ValueError(f"A cache named '{cache_name}' already exists and cannot be replaced.")
+    try:
+        os.symlink(os.path.relpath(target, PERSIST_DIR), link, target_is_directory=True)
+    except OSError:
+        # e.g. Windows without symlink privilege
+        shutil.copytree(target, link)
+
+# ---------------- HTTP ----------------
+# max Graph/download requests in flight during a folder walk
+GRAPH_CONCURRENCY = 8
+
+@st.cache_resource
+def get_http_session() -> requests.Session:
+    # shared across reruns so Graph/SharePoint connections stay alive
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=64))
+    return session
+
+
+async def load_sharepoint_folder(client, semaphore, children_url, headers):
+    """Walk a Graph children listing recursively; download and extract every file concurrently."""
+    async with semaphore:
+        res = await client.get(children_url, headers=headers)
+    res.raise_for_status()
+    items = orjson.loads(res.content).get("value", [])
+
+    async def load_item(item):
+        if item.get("folder"):
+            drive_id = item["parentReference"]["driveId"]
+            subfolder_url = f"https://graph.microsoft.com/v1.0/drives/{drive_id}/items/{item['id']}/children"
+            return await load_sharepoint_folder(client, semaphore, subfolder_url, headers)
+        download_url = item.get("@microsoft.graph.downloadUrl")
+        if not (item.get("file") and download_url):
+            return []
+        async with semaphore:
+            file_res = await client.get(download_url)
+        file_res.raise_for_status()
+        # parse off the event loop so other downloads keep going
+        text = await asyncio.to_thread(get_raw_text_cached, file_res.content, item.get("name"), RAW_TEXT_CACHE_DIR)
+        return [text]
+
+    results = await asyncio.gather(*(load_item(item) for item in items))
+    return [text for texts in results for text in texts]
+
+
+async def load_sharepoint_folder_text(children_url, access_token):
+    limits = httpx.Limits(max_connections=32)
+    async with httpx.AsyncClient(http2=True, limits=limits, timeout=60, follow_redirects=True) as client:
+        texts = await load_sharepoint_folder(client, asyncio.Semaphore(GRAPH_CONCURRENCY), children_url,
+                                             {"Authorization": f"Bearer {access_token}"})
+    return "".join(text + "\n\n" for text in texts)
 
 # ---------------- Session State Defaults ----------------
 for key, default in {
@@ -35,6 +144,10 @@ for key, default in {
     "raw_text": "",
     "qa": None,
     "current_cache_name": None,
+    "query_cache": None,
+    "upload_future": None,
+    "upload_cache_name": None,
+    "upload_status": None,
     "page": "upload"
 }.items():
     if key not in st.session_state:
@@ -52,10 +165,101 @@ if AUTOLOAD and OPENAI_API_KEY:
         vectorstore = load_vectorstore(OPENAI_API_KEY, PERSIST_DIR)
         if vectorstore:
             st.session_state.qa, _ = build_qa_engine("", OPENAI_API_KEY, load_vectorstore_obj=vectorstore)
+            st.session_state.query_cache = None  # cached answers belong to the previous engine
             st.success("✅ Auto-loaded knowledge base from memory")
     except Exception:
         st.info("ℹ️ No auto-loadable memory found.")
 
+# ---------------- Background Upload Processing ----------------
+# uploads processed at once across all sessions; more just queue
+UPLOAD_WORKERS = 2
+
+@st.cache_resource
+def get_upload_executor() -> ThreadPoolExecutor:
+    # shared by every session, so sessions that end leave no idle threads behind
+    return ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix="upload")
+
+
+def process_upload(uploaded_bytes, filename, cache_name):
+    """Extract, embed and persist an upload. Runs on the upload executor, so no st.* calls here."""
+    raw_text = get_raw_text_cached(uploaded_bytes, filename, RAW_TEXT_CACHE_DIR)
+    if not raw_text.strip():
+        raise ValueError("No text extracted from the file.")
+    return raw_text, build_and_link(raw_text, hashlib.sha256(uploaded_bytes).hexdigest(), cache_name)
+
+
+def build_and_link(raw_text, digest, cache_name):
+    """
+    QA engine for raw_text, whose vectorstore is stored once under by_hash/<digest>
+    and linked as cache_name. Stores are never written through a name, so
+    reusing a name cannot overwrite content another name links to.
+    """
+    # identical content under another name reuses its embeddings
+    vectorstore = load_vectorstore(OPENAI_API_KEY, VECTORSTORE_HASH_DIR, cache_name=digest)
+    if vectorstore:
+        qa, _ = build_qa_engine("", OPENAI_API_KEY, load_vectorstore_obj=vectorstore)
+    else:
+        qa, vectorstore = build_qa_engine(raw_text, OPENAI_API_KEY, cache_name=digest)
+        save_vectorstore(vectorstore, VECTORSTORE_HASH_DIR, cache_name=digest)
+    link_cache_name(cache_name, digest)
+    return qa
+
+
+@st.fragment(run_every=1)
+def upload_progress(cache_name):
+    # polls the background job; only called while one is pending
+    future = st.session_state.upload_future
+    if not future.done():
+        st.info("⏳ Extracting text and building QA engine...")
+        return
+    st.session_state.upload_future = None
+    try:
+        raw_text, qa = future.result()
+    except Exception as e:
+        st.session_state.upload_status = ("error", f"❌ Failed to process file: {e}")
+    else:
+        list_caches.clear()
+        st.session_state.raw_text = raw_text
+        st.session_state.qa = qa
+        st.session_state.query_cache = None
+        st.session_state.current_cache_name = cache_name
+        st.session_state.upload_status = ("success", f"✅ Saved knowledge base as '{cache_name}'")
+    st.rerun()
+
+
+# ---------------- Chat Panel ----------------
+@st.fragment
+def chat_panel():
+    # a fragment: submitting a question reruns only this panel, not the page
+    chat_container = st.container()
+    query = st.chat_input("Ask something about the document...")
+
+    if query:
+        with st.spinner("🤖 Thinking..."):
+            try:
+                # one semantic query cache per knowledge base, stored next to it;
+                # an unnamed knowledge base keeps its cache in this session only
+                cache_name = st.session_state.current_cache_name
+                qcache_dir = os.path.join(PERSIST_DIR, cache_name) if cache_name else None
+                if st.session_state.query_cache is None or st.session_state.query_cache.persist_dir != qcache_dir:
+                    st.session_state.query_cache = QueryCache(OPENAI_API_KEY, persist_dir=qcache_dir)
+                result = st.session_state.query_cache.ask(st.session_state.qa, query)
+                st.session_state.chat_history.append({
+                    "question": query,
+                    "answer": result["result"],
+                    "context": result.get("source_documents", [])
+                })
+            except Exception as e:
+                st.error(f"Error while querying QA engine: {e}")
+
+    with chat_container:
+        # one markdown element for the whole history instead of two per turn
+        st.markdown("\n\n".join(
+            f"**You:** {chat['question']}\n\n**Bot:** {chat['answer']}"
+            for chat in st.session_state.chat_history
+        ))
+
+
 # =====================================================================
 #                            PAGE: Upload / Load
 # =====================================================================
@@ -78,20 +282,18 @@ if st.session_state.page == "upload":
 
             cache_name = st.text_input("Cache name for this upload (unique)", value="")
             if st.button("Process & Save to Memory") and uploaded_bytes and filename and cache_name:
-                with st.spinner("⏳ Extracting text and building QA engine..."):
-                    try:
-                        raw_text = get_raw_text(uploaded_bytes, filename)
-                        if not raw_text.strip():
-                            st.error("❌ No text extracted from the file.")
-                        else:
-                            qa, vectorstore = build_qa_engine(raw_text, OPENAI_API_KEY, cache_name=cache_name)
-                            save_vectorstore(vectorstore, PERSIST_DIR, cache_name=cache_name)
-                            st.session_state.raw_text = raw_text
-                            st.session_state.qa = qa
-                            st.session_state.current_cache_name = cache_name
-                            st.success(f"✅ Saved knowledge base as '{cache_name}'")
-                    except Exception as e:
-                        st.error(f"❌ Failed to process file: {e}")
+                if cache_name_error(cache_name):
+                    st.error(cache_name_error(cache_name))
+                elif st.session_state.upload_future is None:
+                    st.session_state.upload_status = None
+                    st.session_state.upload_cache_name = cache_name
+                    st.session_state.upload_future = get_upload_executor().submit(
+                        process_upload, uploaded_bytes, filename, cache_name)
+            if st.session_state.upload_future is not None:
+                upload_progress(st.session_state.upload_cache_name)
+            elif st.session_state.upload_status:
+                kind, message = st.session_state.upload_status
+                (st.success if kind == "success" else st.error)(message)
 
         # -------- SHAREPOINT LINK --------
         elif option == "SharePoint Link":
@@ -99,24 +301,6 @@ if st.session_state.page == "upload":
             sharepoint_url = st.text_input("Enter SharePoint File/Folder URL or Sharing Link")
             cache_name = st.text_input("Cache name for this SharePoint folder (unique)", value="")
 
-            def load_sharepoint_folder(site_id, folder_path, access_token):
-                all_files = []
-                folder_api = f"https://graph.microsoft.com/v1.0/sites/{site_id}/drive/root:/{folder_path}:/children"
-                res = requests.get(folder_api, headers={"Authorization": f"Bearer {access_token}"})
-                res.raise_for_status()
-                items = res.json().get("value", [])
-                for item in items:
-                    if item.get("file"):
-                        download_url = item.get("@microsoft.graph.downloadUrl")
-                        if download_url:
-                            file_res = requests.get(download_url)
-                            file_res.raise_for_status()
-                            all_files.append({"name": item.get("name"), "bytes": io.BytesIO(file_res.content)})
-                    elif item.get("folder"):
-                        subfolder_path = f"{folder_path}/{item['name']}"
-                        all_files.extend(load_sharepoint_folder(site_id, subfolder_path, access_token))
-                return all_files
-
             if st.button("Load from SharePoint (Graph API)"):
                 if not sharepoint_url:
                     st.warning("Please paste a SharePoint URL first.")
@@ -124,9 +308,12 @@ if st.session_state.page == "upload":
                     st.error("SharePoint credentials not set in .env.")
                 elif not cache_name:
                     st.warning("Please provide a unique cache name.")
+                elif cache_name_error(cache_name):
+                    st.error(cache_name_error(cache_name))
                 else:
                     with st.spinner("🔄 Loading files from SharePoint..."):
                         try:
+                            http = get_http_session()
                             token_url = f"https://login.microsoftonline.com/{TENANT_ID}/oauth2/v2.0/token"
                             token_data = {
                                 "grant_type": "client_credentials",
@@ -134,44 +321,45 @@ if st.session_state.page == "upload":
                                 "client_secret": CLIENT_SECRET,
                                 "scope": "https://graph.microsoft.com/.default"
                             }
-                            token_response = requests.post(token_url, data=token_data)
+                            token_response = http.post(token_url, data=token_data)
                             token_response.raise_for_status()
-                            access_token = token_response.json().get("access_token")
+                            access_token = orjson.loads(token_response.content).get("access_token")
 
                             encoded_url = base64.urlsafe_b64encode(sharepoint_url.strip().encode("utf-8")).decode("utf-8").rstrip("=")
                             meta_url = f"https://graph.microsoft.com/v1.0/shares/u!{encoded_url}/driveItem"
-                            meta_res = requests.get(meta_url, headers={"Authorization": f"Bearer {access_token}"})
+                            meta_res = http.get(meta_url, headers={"Authorization": f"Bearer {access_token}"})
                             meta_res.raise_for_status()
-                            meta_json = meta_res.json()
+                            meta_json = orjson.loads(meta_res.content)
 
                             if meta_json.get("folder"):
                                 children_url = f"{meta_url}/children"
-                                children_res = requests.get(children_url, headers={"Authorization": f"Bearer {access_token}"})
-                                children_res.raise_for_status()
-                                items = children_res.json().get("value", [])
-                                all_text = ""
-                                for item in items:
-                                    if item.get("file"):
-                                        download_url = item.get("@microsoft.graph.downloadUrl")
-                                        if download_url:
-                                            file_res = requests.get(download_url)
-                                            file_res.raise_for_status()
-                                            all_text += get_raw_text(file_res.content, item.get("name")) + "\n\n"
-                                qa, vectorstore = build_qa_engine(all_text, OPENAI_API_KEY, cache_name=cache_name)
-                                save_vectorstore(vectorstore, PERSIST_DIR, cache_name=cache_name)
+                                all_text = asyncio.run(load_sharepoint_folder_text(children_url, access_token))
+                                qa = build_and_link(all_text, text_digest(all_text), cache_name)
+                                list_caches.clear()
                                 st.session_state.qa = qa
+                                st.session_state.query_cache = None
                                 st.session_state.current_cache_name = cache_name
                                 st.success(f"✅ Loaded and saved folder as '{cache_name}'")
                             else:
                                 filename = meta_json.get("name", "sharepoint_file")
                                 download_url = meta_json.get("@microsoft.graph.downloadUrl")
                                 if download_url:
-                                    file_res = requests.get(download_url)
-                                    file_res.raise_for_status()
-                                    raw_text = get_raw_text(file_res.content, filename)
-                                    qa, vectorstore = build_qa_engine(raw_text, OPENAI_API_KEY, cache_name=cache_name)
-                                    save_vectorstore(vectorstore, PERSIST_DIR, cache_name=cache_name)
+                                    # spool to disk and parse from an mmap so large files
+                                    # are paged in on demand instead of held in RAM
+                                    with http.get(download_url, stream=True) as file_res, tempfile.TemporaryFile() as tmp:
+                                        file_res.raise_for_status()
+                                        for block in file_res.iter_content(chunk_size=1 << 20):
+                                            tmp.write(block)
+                                        tmp.flush()
+                                        if tmp.tell():
+                                            with mmap.mmap(tmp.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                                                raw_text = get_raw_text_cached(mapped, filename, RAW_TEXT_CACHE_DIR)
+                                        else:
+                                            raw_text = ""
+                                    qa = build_and_link(raw_text, text_digest(raw_text), cache_name)
+                                    list_caches.clear()
                                     st.session_state.qa = qa
+                                    st.session_state.query_cache = None
                                     st.session_state.current_cache_name = cache_name
                                     st.success(f"✅ Loaded and saved file as '{cache_name}'")
                         except Exception as e:
@@ -186,7 +374,7 @@ if st.session_state.page == "upload":
         # -------- MEMORY SECTION --------
         st.markdown("---")
         st.markdown("### 🧠 Persistent Memory")
-        caches = [d for d in os.listdir(PERSIST_DIR) if os.path.isdir(os.path.join(PERSIST_DIR, d))]
+        caches = list_caches()
         st.write("Available caches:", caches if caches else "No saved caches yet.")
         selected_cache = st.selectbox("Select cache to load", options=["-- select --"] + caches)
 
@@ -196,6 +384,7 @@ if st.session_state.page == "upload":
                     vectorstore = load_vectorstore(OPENAI_API_KEY, PERSIST_DIR, cache_name=selected_cache)
                     if vectorstore:
                         st.session_state.qa, _ = build_qa_engine("", OPENAI_API_KEY, load_vectorstore_obj=vectorstore)
+                        st.session_state.query_cache = None
                         st.session_state.current_cache_name = selected_cache
                         st.success(f"✅ Loaded '{selected_cache}' into memory.")
                 except Exception as e:
@@ -203,6 +392,7 @@ if st.session_state.page == "upload":
 
         if st.button("Clear memory selection"):
             st.session_state.qa = None
+            st.session_state.query_cache = None
             st.session_state.current_cache_name = None
             st.success("Cleared in-memory QA engine.")
 
@@ -226,22 +416,4 @@ elif st.session_state.page == "chat":
             st.rerun()
             st.stop()
 
-        chat_container = st.container()
-        query = st.chat_input("Ask something about the document...")
-
-        if query:
-            with st.spinner("🤖 Thinking..."):
-                try:
-                    result = st.session_state.qa({"query": query})
-                    st.session_state.chat_history.append({
-                        "question": query,
-                        "answer": result["result"],
-                        "context": result.get("source_documents", [])
-                    })
-                except Exception as e:
-                    st.error(f"Error while querying QA engine: {e}")
-
-        with chat_container:
-            for chat in st.session_state.chat_history:
-                st.markdown(f"**You:** {chat['question']}")
-                st.markdown(f"**Bot:** {chat['answer']}")
+        chat_panel()
@@ -1,12 +1,19 @@
 import streamlit as st
 import os
-import io
+import shutil
+import tempfile
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 from urllib.parse import urlparse
 import base64
-from file_loader import get_raw_text
-from qa_engine import build_qa_engine
+import hashlib
+import msal
+from langchain_core.callbacks import BaseCallbackHandler
+from file_loader import get_raw_text, get_raw_text_from_file
+from qa_engine import (build_qa_engine, save_vectorstore, load_vectorstore, QueryCache,
+                       DEFAULT_MODEL, CHUNK_SIZE, CHUNK_OVERLAP, VECTORSTORE_CACHE_SIZE)
 import time
 # ---------------- Load Environment ----------------
 dotenv_path = os.path.join(os.path.dirname(__file__), ".env")
@@ -16,6 +23,168 @@ tenant_id = os.getenv("TENANT_ID")
 client_id = os.getenv("CLIENT_ID")
 client_secret = os.getenv("CLIENT_SECRET")
 
+# ---------------- Persistence ----------------
+PERSIST_DIR = os.path.join(os.path.dirname(__file__), "persisted_data")
+# same content-addressed layout main.py uses for uploads
+VECTORSTORE_HASH_DIR = os.path.join(PERSIST_DIR, "by_hash")
+HASH_SLICE_CHARS = 1 << 20
+# in-memory engines expire after this long; by_hash still has their indexes on disk
+ENGINE_CACHE_TTL = 6 * 3600
+
+@st.cache_resource(show_spinner=False, max_entries=VECTORSTORE_CACHE_SIZE, ttl=ENGINE_CACHE_TTL)
+def _build_cached(text_hash, model_name, chunk_size, chunk_overlap, _raw_text, _api_key):
+    # underscore args are left out of the cache key: the text is represented
+    # by its hash and the API key must not be hashed into it
+    vectorstore = load_vectorstore(_api_key, VECTORSTORE_HASH_DIR, cache_name=text_hash)
+    if vectorstore:
+        qa, _ = build_qa_engine("", _api_key, model_name=model_name, load_vectorstore_obj=vectorstore)
+    else:
+        qa, vectorstore = build_qa_engine(_raw_text, _api_key, model_name=model_name,
+                                          chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        save_vectorstore(vectorstore, VECTORSTORE_HASH_DIR, cache_name=text_hash)
+    return qa
+
+def get_qa_engine(docs):
+    """
+    QA chain for docs, reusing the in-process or on-disk index for identical text.
+    docs is one text or a folder's per-file texts; a list is hashed as the
+    blank-line join of its texts without building that string, and a new index
+    is then sanitized in one batch and chunked per file.
+    Returns (qa, text_hash); the hash names the index's directory under VECTORSTORE_HASH_DIR.
+    """
+    # hash in slices: encoding a whole text at once would copy a folder's worth of text again
+    h = hashlib.blake2b()
+    for text in ([docs] if isinstance(docs, str) else docs):
+        for start in range(0, len(text), HASH_SLICE_CHARS):
+            h.update(text[start:start + HASH_SLICE_CHARS].encode("utf-8"))
+        if not isinstance(docs, str):
+            h.update(b"\n\n")
+    text_hash = h.hexdigest()
+    return _build_cached(text_hash, DEFAULT_MODEL, CHUNK_SIZE, CHUNK_OVERLAP, docs, openai_api_key), text_hash
+
+# ---------------- HTTP ----------------
+DOWNLOAD_WORKERS = 10
+# downloads up to this size stay in memory, larger ones spill to a temp file
+SPOOL_MAX_SIZE = 8 * 1024 * 1024
+GRAPH_BATCH_URL = "https://graph.microsoft.com/v1.0/$batch"
+GRAPH_BATCH_LIMIT = 20  # max sub-requests Graph accepts per $batch
+# sub-request statuses worth retrying, and how many times
+GRAPH_RETRY_STATUSES = {429, 503, 504}
+GRAPH_BATCH_RETRIES = 5
+# files parsed at once in folder loads; big PDFs additionally fan out to processes in file_loader
+EXTRACT_WORKERS = os.cpu_count() or 1
+
+@st.cache_resource
+def get_http_session():
+    # one keep-alive pool shared by all reruns
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=20, pool_maxsize=20))
+    return session
+
+# ---------------- Graph Token ----------------
+TOKEN_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "docchatbot", "msal_token_cache.json")
+GRAPH_SCOPES = ["https://graph.microsoft.com/.default"]
+
+def _write_token_file(serialized):
+    os.makedirs(os.path.dirname(TOKEN_CACHE_PATH), exist_ok=True)
+    fd = os.open(TOKEN_CACHE_PATH, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(serialized)
+
+@st.cache_resource(max_entries=4)
+def get_msal_app(tenant_id, client_id, secret_hash, _client_secret, _session):
+    # one MSAL client per tenant/app/secret for all sessions; its token cache is
+    # seeded from disk so a restart does not mean a new token request. The
+    # secret is keyed by its hash, so a rotated secret gets a new client
+    cache = msal.SerializableTokenCache()
+    try:
+        with open(TOKEN_CACHE_PATH, encoding="utf-8") as f:
+            cache.deserialize(f.read())
+    except (OSError, ValueError):
+        pass
+    return msal.ConfidentialClientApplication(
+        client_id,
+        authority=f"https://login.microsoftonline.com/{tenant_id}",
+        client_credential=_client_secret,
+        token_cache=cache,
+        http_client=_session,
+    )
+
+def get_graph_token(session, tenant_id, client_id, client_secret):
+    """Client-credentials token for Graph; MSAL serves it from cache until it is due for refresh."""
+    secret_hash = hashlib.sha256((client_secret or "").encode("utf-8")).hexdigest()
+    app = get_msal_app(tenant_id, client_id, secret_hash, client_secret, session)
+    result = app.acquire_token_for_client(scopes=GRAPH_SCOPES)
+    if "access_token" not in result:
+        raise RuntimeError(f"Could not get Graph token: {result.get('error_description') or result.get('error')}")
+    if app.token_cache.has_state_changed:
+        _write_token_file(app.token_cache.serialize())
+        app.token_cache.has_state_changed = False
+    return result["access_token"]
+
+def graph_batch_get(session, access_token, urls):
+    """
+    GET Graph URLs (relative to /v1.0) through $batch; returns response bodies in input order.
+    Graph throttles sub-requests one by one, so throttled or unavailable ones are
+    retried after their Retry-After; errors that persist raise RuntimeError.
+    """
+    bodies = [None] * len(urls)
+    pending = list(range(len(urls)))
+    for attempt in range(GRAPH_BATCH_RETRIES + 1):
+        retry = []
+        retry_after = 0.0
+        for start in range(0, len(pending), GRAPH_BATCH_LIMIT):
+            chunk = pending[start:start + GRAPH_BATCH_LIMIT]
+            payload = {"requests": [{"id": str(i), "method": "GET", "url": urls[i]} for i in chunk]}
+            res = session.post(GRAPH_BATCH_URL, json=payload, headers={"Authorization": f"Bearer {access_token}"})
+            res.raise_for_status()
+            responses = {r["id"]: r for r in res.json().get("responses", [])}
+            for i in chunk:
+                sub = responses[str(i)]
+                if sub["status"] < 400:
+                    bodies[i] = sub["body"]
+                elif sub["status"] in GRAPH_RETRY_STATUSES and attempt < GRAPH_BATCH_RETRIES:
+                    retry.append(i)
+                    headers = {k.lower(): v for k, v in (sub.get("headers") or {}).items()}
+                    try:
+                        retry_after = max(retry_after, float(headers.get("retry-after", 0)))
+                    except ValueError:
+                        pass
+                else:
+                    raise RuntimeError(f"Graph request {urls[i]} failed: {sub['status']} - {sub.get('body')}")
+        if not retry:
+            break
+        time.sleep(retry_after or 2 ** attempt)
+        pending = retry
+    return bodies
+
+def download_to_spool(session, url):
+    """Stream a download into a SpooledTemporaryFile, so big files never sit in memory whole."""
+    buf = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    with session.get(url, stream=True) as res:
+        res.raise_for_status()
+        res.raw.decode_content = True
+        shutil.copyfileobj(res.raw, buf, length=1 << 20)
+    buf.seek(0)
+    return buf
+
+def download_files(session, items):
+    """Download Graph file items in parallel; returns [(name, file)] in input order."""
+    def fetch(item):
+        return item.get("name"), download_to_spool(session, item["@microsoft.graph.downloadUrl"])
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as ex:
+        return list(ex.map(fetch, items))
+
+def extract_files(files):
+    """Parse downloaded [(name, file)] concurrently; returns texts in input order and closes the files."""
+    def extract(pair):
+        name, f = pair
+        with f:
+            return get_raw_text_from_file(f, name)
+    with ThreadPoolExecutor(max_workers=EXTRACT_WORKERS) as ex:
+        return list(ex.map(extract, files))
+
+
 if "page_initialized" not in st.session_state:
     with st.spinner("🔧 Initializing app..."):
         time.sleep(2)  # simulate load
@@ -23,12 +192,18 @@ if "page_initialized" not in st.session_state:
 # ---------------- Session State ----------------
 if "chat_history" not in st.session_state:
     st.session_state.chat_history = []
-if "last_uploaded_file_bytes" not in st.session_state:
-    st.session_state.last_uploaded_file_bytes = None
+if "last_uploaded_hash" not in st.session_state:
+    st.session_state.last_uploaded_hash = None
+if "last_uploaded_id" not in st.session_state:
+    st.session_state.last_uploaded_id = None
 if "raw_text" not in st.session_state:
     st.session_state.raw_text = ""
 if "qa" not in st.session_state:
     st.session_state.qa = None
+if "doc_hash" not in st.session_state:
+    st.session_state.doc_hash = None
+if "query_cache" not in st.session_state:
+    st.session_state.query_cache = None
 
 # ---------------- Streamlit Page ----------------
 st.set_page_config(page_title="Doc Chatbot", layout="wide")
@@ -43,8 +218,7 @@ with left:
 
     option = st.radio("Choose Input Method:", ["Upload File", "SharePoint Link"])
 
-    uploaded_bytes = None
-    filename = ""
+    uploaded_file = None
 
     # --- Local Upload ---
     if option == "Upload File":
@@ -52,33 +226,31 @@ with left:
             "Upload PDF, DOCX, Excel, or ZIP",
             type=["pdf", "docx", "xls", "xlsx", "zip"]
         )
-        if uploaded_file:
-            uploaded_bytes = uploaded_file.read()
-            filename = uploaded_file.name
 
     # --- SharePoint via Graph API ---
     elif option == "SharePoint Link":
         st.markdown("Load documents from SharePoint (single file or folder).")
         sharepoint_url = st.text_input("Enter SharePoint File/Folder URL or Sharing Link")
 
-        def load_sharepoint_folder(site_id, folder_path, access_token):
+        def load_sharepoint_folder(session, site_id, folder_path, access_token):
+            # breadth-first: every folder of one level is listed in a single $batch round-trip.
+            # folder_path comes from the URL and is already encoded; subfolders go by item id,
+            # since $batch URLs are not encoded for us
             all_files = []
-            folder_api = f"https://graph.microsoft.com/v1.0/sites/{site_id}/drive/root:/{folder_path}:/children"
-            res = requests.get(folder_api, headers={"Authorization": f"Bearer {access_token}"})
-            res.raise_for_status()
-            items = res.json().get("value", [])
-
-            for item in items:
-                if item.get("file"):
-                    download_url = item.get("@microsoft.graph.downloadUrl")
-                    if download_url:
-                        file_res = requests.get(download_url)
-                        file_res.raise_for_status()
-                        all_files.append({"name": item.get("name"), "bytes": io.BytesIO(file_res.content)})
-                elif item.get("folder"):
-                    # Recursive call for subfolder
-                    subfolder_path = f"{folder_path}/{item['name']}"
-                    all_files.extend(load_sharepoint_folder(site_id, subfolder_path, access_token))
+            folders = [f"/sites/{site_id}/drive/root:/{folder_path}:/children"]
+            while folders:
+                listings = graph_batch_get(session, access_token, folders)
+                file_items = []
+                subfolders = []
+                for listing in listings:
+                    for item in listing.get("value", []):
+                        if item.get("file") and item.get("@microsoft.graph.downloadUrl"):
+                            file_items.append(item)
+                        elif item.get("folder"):
+                            subfolders.append(f"/sites/{site_id}/drive/items/{item['id']}/children")
+                for name, f in download_files(session, file_items):
+                    all_files.append({"name": name, "file": f})
+                folders = subfolders
 
             return all_files
 
@@ -87,17 +259,10 @@ with left:
             if sharepoint_url:
                 with st.spinner("🔄 Loading files from SharePoint... Please wait."):
                     try:
+                        session = get_http_session()
+
                         # ---------------- Step 1 — Get Access Token ----------------
-                        token_url = f"https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0/token"
-                        token_data = {
-                            "grant_type": "client_credentials",
-                            "client_id": client_id,
-                            "client_secret": client_secret,
-                            "scope": "https://graph.microsoft.com/.default"
-                        }
-                        token_response = requests.post(token_url, data=token_data)
-                        token_response.raise_for_status()
-                        access_token = token_response.json().get("access_token")
+                        access_token = get_graph_token(session, tenant_id, client_id, client_secret)
 
                         # ---------------- Step 2 — Detect URL Type ----------------
                         # Detect if it is a folder link
@@ -107,26 +272,25 @@ with left:
                             
                             # Get folder metadata
                             folder_meta_url = f"https://graph.microsoft.com/v1.0/shares/u!{encoded_url}/driveItem/children"
-                            folder_res = requests.get(folder_meta_url, headers={"Authorization": f"Bearer {access_token}"})
+                            folder_res = session.get(folder_meta_url, headers={"Authorization": f"Bearer {access_token}"})
                             folder_res.raise_for_status()
                             items = folder_res.json().get("value", [])
                             
                             if not items:
                                 st.warning("⚠️ No files found in the folder.")
                             else:
-                                all_text = ""
-                                for item in items:
-                                    if item.get("file"):  # skip subfolders
-                                        download_url = item.get("@microsoft.graph.downloadUrl")
-                                        if download_url:
-                                            file_res = requests.get(download_url)
-                                            file_res.raise_for_status()
-                                            all_text += get_raw_text(io.BytesIO(file_res.content).getvalue(), item.get("name")) + "\n\n"
+                                # skip subfolders
+                                file_items = [item for item in items if item.get("file") and item.get("@microsoft.graph.downloadUrl")]
+                                texts = extract_files(download_files(session, file_items))
                                 
-                                st.session_state.last_uploaded_file_bytes = None
+                                st.session_state.last_uploaded_hash = None
+                                st.session_state.last_uploaded_id = None
                                 st.session_state.chat_history = []
-                                st.session_state.raw_text = all_text
-                                st.session_state.qa = build_qa_engine(all_text, openai_api_key)
+                                st.session_state.qa, st.session_state.doc_hash = get_qa_engine(texts)
+                                # joined only once the index exists, so indexing never holds two copies
+                                st.session_state.raw_text = "".join(text + "\n\n" for text in texts)
+                                del texts
+                                st.session_state.query_cache = None  # cached answers belong to the previous engine
                                 st.success(f"✅ Loaded {len(items)} files from folder successfully")
 
                         elif "/:b:/" in sharepoint_url or "/:w:/" in sharepoint_url:
@@ -136,21 +300,21 @@ with left:
 
                             # Get metadata
                             meta_url = f"https://graph.microsoft.com/v1.0/shares/u!{encoded_url}/driveItem"
-                            meta_res = requests.get(meta_url, headers={"Authorization": f"Bearer {access_token}"})
+                            meta_res = session.get(meta_url, headers={"Authorization": f"Bearer {access_token}"})
                             meta_res.raise_for_status()
                             meta_json = meta_res.json()
 
                             filename = meta_json.get("name", "sharepoint_file")
                             download_url = meta_json.get("@microsoft.graph.downloadUrl")
                             if download_url:
-                                res = requests.get(download_url)
-                                res.raise_for_status()
-                                uploaded_bytes = io.BytesIO(res.content)
-                                # Process file
-                                st.session_state.last_uploaded_file_bytes = None
+                                # Process file (handled here, not by the upload block below)
+                                st.session_state.last_uploaded_hash = None
+                                st.session_state.last_uploaded_id = None
                                 st.session_state.chat_history = []
-                                st.session_state.raw_text = get_raw_text(uploaded_bytes.getvalue(), filename)
-                                st.session_state.qa = build_qa_engine(st.session_state.raw_text, openai_api_key)
+                                with download_to_spool(session, download_url) as f:
+                                    st.session_state.raw_text = get_raw_text_from_file(f, filename)
+                                st.session_state.qa, st.session_state.doc_hash = get_qa_engine(st.session_state.raw_text)
+                                st.session_state.query_cache = None
                                 st.success(f"✅ {filename} loaded successfully")
                             else:
                                 st.error("⚠️ Could not get download URL from Graph metadata.")
@@ -165,23 +329,25 @@ with left:
 
                             # Step 3 — Get Site ID
                             site_api = f"https://graph.microsoft.com/v1.0/sites/{site_hostname}:/sites/{site_name}"
-                            site_res = requests.get(site_api, headers={"Authorization": f"Bearer {access_token}"})
+                            site_res = session.get(site_api, headers={"Authorization": f"Bearer {access_token}"})
                             site_res.raise_for_status()
                             site_id = site_res.json()["id"]
 
                             # Step 4 — Load all files in folder
-                            all_files = load_sharepoint_folder(site_id, relative_path, access_token)
+                            all_files = load_sharepoint_folder(session, site_id, relative_path, access_token)
                             if not all_files:
                                 st.warning("⚠️ No files found in the folder.")
                             else:
-                                all_text = ""
-                                for file in all_files:
-                                    all_text += get_raw_text(file["bytes"].getvalue(), file["name"]) + "\n\n"
+                                texts = extract_files([(file["name"], file["file"]) for file in all_files])
 
-                                st.session_state.last_uploaded_file_bytes = None
+                                st.session_state.last_uploaded_hash = None
+                                st.session_state.last_uploaded_id = None
                                 st.session_state.chat_history = []
-                                st.session_state.raw_text = all_text
-                                st.session_state.qa = build_qa_engine(all_text, openai_api_key)
+                                st.session_state.qa, st.session_state.doc_hash = get_qa_engine(texts)
+                                # joined only once the index exists, so indexing never holds two copies
+                                st.session_state.raw_text = "".join(text + "\n\n" for text in texts)
+                                del texts
+                                st.session_state.query_cache = None
                                 st.success(f"✅ Loaded {len(all_files)} files from folder successfully")
 
                     except requests.exceptions.HTTPError as e:
@@ -190,46 +356,67 @@ with left:
                         st.error(f"❌ Unexpected Error: {e}")
 
 # ---------------- Process Uploaded File ----------------
-if uploaded_bytes and filename:
+# the uploader returns the same file_id on every rerun, so a file is read and hashed once
+if uploaded_file is not None and st.session_state.last_uploaded_id != uploaded_file.file_id:
     with st.spinner("⏳ Extracting text and building QA engine..."):
-        if st.session_state.last_uploaded_file_bytes != uploaded_bytes:
-            st.session_state.last_uploaded_file_bytes = uploaded_bytes
+        st.session_state.last_uploaded_id = uploaded_file.file_id
+        uploaded_bytes = uploaded_file.getvalue()
+        # the same content uploaded again keeps its engine and chat
+        uploaded_hash = hashlib.blake2b(uploaded_bytes, digest_size=16).hexdigest()
+        if st.session_state.last_uploaded_hash != uploaded_hash:
+            st.session_state.last_uploaded_hash = uploaded_hash
             st.session_state.chat_history = []
 
-            st.session_state.raw_text = get_raw_text(
-                uploaded_bytes if isinstance(uploaded_bytes, bytes) else uploaded_bytes.getvalue(),
-                filename
-            )
+            st.session_state.raw_text = get_raw_text(uploaded_bytes, uploaded_file.name)
             if not st.session_state.raw_text.strip():
                 st.error("❌ No text could be extracted from the uploaded file. Please check file format or content.")
                 st.stop()
 
             st.write("📏 Extracted text length:", len(st.session_state.raw_text))
-            st.session_state.qa = build_qa_engine(st.session_state.raw_text, openai_api_key)
+            st.session_state.qa, st.session_state.doc_hash = get_qa_engine(st.session_state.raw_text)
+            st.session_state.query_cache = None
 
         # with st.expander("Preview Extracted Text"):
         #     st.text_area("Extracted Content", st.session_state.raw_text[:5000], height=400)
 
 # ---------------- RIGHT: Chat ----------------
+class StreamToPlaceholder(BaseCallbackHandler):
+    """Render LLM tokens into a Streamlit placeholder as they arrive."""
+
+    def __init__(self, placeholder):
+        self.placeholder = placeholder
+        self.tokens = []
+
+    def on_llm_new_token(self, token, **kwargs):
+        self.tokens.append(token)
+        self.placeholder.markdown("".join(self.tokens))
+
 with right:
     st.header("💬 Chat with Document")
 
     chat_container = st.container()
     query = st.chat_input("Ask something about the document...")
 
-    if query and st.session_state.qa:
-        result = st.session_state.qa({"query": query})
-        st.session_state.chat_history.append({
-            "question": query,
-            "answer": result["result"],
-            "context": result["source_documents"]
-        })
-
     # Show chat history
     with chat_container:
         for chat in st.session_state.chat_history:
-            st.markdown(f"**You:** {chat['question']}")
-            st.markdown(f"**Bot:** {chat['answer']}")
-            # with st.expander("🔍 Relevant Context"):
-            #     for doc in chat["context"]:
-            #         st.write(doc.page_content[:300] + "...")
+            with st.chat_message("user"):
+                st.markdown(chat["question"])
+            with st.chat_message("assistant"):
+                st.markdown(chat["answer"])
+
+        # the earlier turns are already on screen; stream the new answer below them
+        if query and st.session_state.qa:
+            with st.chat_message("user"):
+                st.markdown(query)
+            # semantic cache per document, stored next to its index: paraphrased
+            # repeats are answered without a retrieval/LLM round-trip
+            qcache_dir = os.path.join(VECTORSTORE_HASH_DIR, st.session_state.doc_hash)
+            if st.session_state.query_cache is None or st.session_state.query_cache.persist_dir != qcache_dir:
+                st.session_state.query_cache = QueryCache(openai_api_key, persist_dir=qcache_dir)
+            with st.chat_message("assistant"):
+                stream = StreamToPlaceholder(st.empty())
+                result = st.session_state.query_cache.ask(st.session_state.qa, query, callbacks=[stream])
+                stream.placeholder.markdown(result["result"])
+            # the context is not shown, so history keeps only the text of each turn
+            st.session_state.chat_history.append({"question": query, "answer": result["result"]})
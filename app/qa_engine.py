@@ -1,86 +1,521 @@
 import os
 import re
-from typing import Optional, Tuple
+import asyncio
+import math
+import bisect
+import time
+import pickle
+import random
+import hashlib
+import sqlite3
+import tempfile
+import threading
+from collections import OrderedDict, deque
+from contextlib import closing, contextmanager
+from functools import lru_cache
+from typing import List, Optional, Sequence, Tuple, Union
+import faiss
+import httpx
+import numpy as np
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_openai import ChatOpenAI, OpenAIEmbeddings
 from langchain_community.vectorstores import FAISS
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_core.embeddings import Embeddings
 from langchain.chains import RetrievalQA
+from langchain.retrievers import ContextualCompressionRetriever
+from langchain.retrievers.document_compressors import DocumentCompressorPipeline, EmbeddingsFilter
+from langchain_community.document_transformers import LongContextReorder
+from langchain_core.documents import BaseDocumentTransformer, Document
 from langchain.prompts import PromptTemplate
 import spacy
+import tiktoken
+from dotenv import load_dotenv
+try:
+    import fcntl
+except ImportError:  # Windows: query cache saves stay atomic but are not serialized
+    fcntl = None
+try:
+    # native splitter (paragraph > sentence > word boundaries), much faster on multi-MB text
+    from semantic_text_splitter import TextSplitter as _RustTextSplitter
+except ImportError:
+    _RustTextSplitter = None
+
+# the settings below are read from the environment at import; every app imports
+# this module before calling load_dotenv, so pick up app/.env here (it never
+# overrides variables that are already set)
+load_dotenv(os.path.join(os.path.dirname(__file__), ".env"))
 
 # default model names and chunk config
 DEFAULT_MODEL = "gpt-4o"  # adjust to your available model
 CHUNK_SIZE = 1000
 CHUNK_OVERLAP = 100
+# texts per embeddings request; OpenAI caps a request at 2048 inputs and
+# ~300k tokens. Dense or non-English chunks can run to several hundred tokens,
+# so 1024 of them may pass the token cap; 512 leaves headroom
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "512"))
+EMBED_MAX_RETRIES = 6
+EMBED_REQUEST_TIMEOUT = 60  # seconds per embeddings request
+# OpenAI embedding batches in flight at once; the client's retries back off on 429s
+EMBED_CONCURRENCY = 8
+
+# embeddings backend: "openai" (default) or "local" to embed in-process with a
+# sentence-transformers model (needs sentence-transformers/torch installed).
+# Indexes are not portable between backends, so rebuild caches after switching.
+EMBEDDINGS_BACKEND = os.getenv("EMBEDDINGS_BACKEND", "openai").lower()
+LOCAL_EMBED_MODEL = os.getenv("LOCAL_EMBED_MODEL", "BAAI/bge-small-en-v1.5")
+LOCAL_EMBED_BATCH_SIZE = 64
+
+# on-disk cache of chunk embeddings, shared by every knowledge base
+EMBED_CACHE_PATH = os.getenv(
+    "EMBED_CACHE_PATH", os.path.join(os.path.expanduser("~"), ".cache", "docchatbot", "embeddings.sqlite")
+)
+EMBED_CACHE_SELECT_BATCH = 500  # keys per SELECT ... IN (...), under SQLite's variable limit
+# least recently used vectors beyond this many rows are evicted (~6 KB each at 1536 dims)
+EMBED_CACHE_MAX_ROWS = int(os.getenv("EMBED_CACHE_MAX_ROWS", "500000"))
+# a hit only rewrites its last-used time when that is older than this
+EMBED_CACHE_TOUCH_INTERVAL = 24 * 3600
+# recent question vectors: the query cache, retriever and embeddings filter all embed the same question
+QUERY_EMBED_CACHE_SIZE = 256
+
+# vector index: exhaustive scan up to HNSW_MIN_CHUNKS chunks, HNSW graph above
+HNSW_MIN_CHUNKS = 5000
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 80
+HNSW_EF_SEARCH = 64
+# above IVF_MIN_CHUNKS: inverted file over PQ codes (IVF_PQ_M bytes per vector)
+IVF_MIN_CHUNKS = 50_000
+IVF_PQ_M = 16
+IVF_NPROBE = 8
+# random sample an index that needs training (SQ/IVF) is trained on before
+# the corpus streams in; IVF k-means wants ~39 points per centroid on top
+INDEX_TRAIN_SAMPLE = 4096
+# store vectors as int8 codes (4x smaller than float32); set FAISS_SQ8=0 for exact floats
+FAISS_SQ8 = os.getenv("FAISS_SQ8", "1") != "0"
+# loaded vectorstores kept in memory per process
+VECTORSTORE_CACHE_SIZE = 8
+# RetrievalQA chains kept per (vectorstore, model); each holds its vectorstore alive
+CHAIN_CACHE_SIZE = 8
+# FAISS_MMAP=1 memory-maps persisted indexes read-only instead of loading them into RAM
+FAISS_MMAP = os.getenv("FAISS_MMAP") == "1"
+# IO_FLAG_MMAP covers IVF lists; newer faiss also maps flat/SQ codes with IO_FLAG_MMAP_IFC
+_FAISS_MMAP_FLAGS = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY | getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+
+# retrieval: chunks less similar than this to the query are dropped, and the
+# context stuffed into the prompt is capped at this many tokens
+RETRIEVAL_K = 6
+RETRIEVAL_MIN_SIMILARITY = 0.75
+RETRIEVAL_TOKEN_BUDGET = 1200
+
+# semantic query cache: min cosine similarity for a hit, and entry lifetime
+QUERY_CACHE_THRESHOLD = 0.95
+QUERY_CACHE_TTL = 24 * 3600
+QUERY_CACHE_FILE = "qcache.pkl"
 
 # ----------------------- SANITIZATION LOGIC -----------------------
-def sanitize_text(text: str) -> str:
-    """
-    Removes or masks client-specific identifiers before vectorization.
-    Covers: Emails, URLs/domains, phone numbers, organizations, person names, and locations.
-    """
-    # Regex-based anonymization for structured identifiers
-    text = re.sub(r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b', "[EMAIL]", text)  # Emails
-    text = re.sub(r'\b(?:https?://)?(?:www\.)?[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b', "[DOMAIN]", text)  # Domains/URLs
-    text = re.sub(r'\b\d{3,4}[- ]?\d{6,10}\b', "[PHONE]", text)  # Phone numbers
+# only the NER component is used; the rest is not even loaded. tok2vec is
+# kept so pipelines whose ner listens to it keep working
+SPACY_EXCLUDED = ["parser", "tagger", "lemmatizer", "attribute_ruler", "senter"]
+# text is run through NER in windows of about this many characters
+SPACY_WINDOW_CHARS = 50_000
+# run NER on the GPU when one is available (needs spacy[cuda]); windows then
+# go through a single process, since worker processes cannot share the device
+SPACY_PREFER_GPU = os.getenv("SPACY_PREFER_GPU") == "1"
+
+# NER worker processes for multi-window/multi-file text. One by default: the
+# apps sanitize from worker threads of the Streamlit server, and forking a
+# multithreaded process can deadlock (each worker also reloads spaCy). Raise it
+# only for single-threaded batch ingestion
+SPACY_PROCESSES = max(1, int(os.getenv("SPACY_PROCESSES", "1")))
+# LAZY_SPACY=1 skips NER at ingest and masks only the regex identifiers: much
+# faster bulk indexing, but names/orgs/places then reach the embeddings API
+LAZY_SPACY = os.getenv("LAZY_SPACY", "0") == "1"
+# entity labels masked by NER: orgs, people, locations
+TARGET_LABELS = frozenset({"ORG", "PERSON", "GPE", "LOC"})
+
+# SANITIZE_RE2=1 matches with google-re2 (linear-time automaton, no backtracking)
+# when it is installed; plain `re` otherwise
+_re_engine = re
+if os.getenv("SANITIZE_RE2") == "1":
+    try:
+        import re2 as _re_engine
+    except ImportError:
+        pass
+
+# structured identifiers, matched in one scan; the group name is the mask label
+_SANI_RE = _re_engine.compile(
+    r"\b(?:"
+    r"(?P<EMAIL>[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,})"  # Emails
+    r"|(?P<DOMAIN>(?:https?://)?(?:www\.)?[A-Za-z0-9.-]+\.[A-Za-z]{2,})"  # Domains/URLs
+    r"|(?P<PHONE>\d{3,4}[- ]?\d{6,10})"  # Phone numbers
+    r")\b"
+)
+
 
-    # Load lightweight spaCy model for entity detection
+@lru_cache(maxsize=1)
+def _get_nlp():
+    """Load the lightweight spaCy model once per process."""
+    if SPACY_PREFER_GPU:
+        spacy.prefer_gpu()
     try:
-        nlp = spacy.load("en_core_web_sm")
+        return spacy.load("en_core_web_sm", exclude=SPACY_EXCLUDED)
     except OSError:
         # fallback if model not downloaded
         from spacy.cli import download
         download("en_core_web_sm")
-        nlp = spacy.load("en_core_web_sm")
+        return spacy.load("en_core_web_sm", exclude=SPACY_EXCLUDED)
 
-    doc = nlp(text)
-    sanitized_text = text
 
-    for ent in doc.ents:
-        if ent.label_ in ["ORG", "PERSON", "GPE", "LOC"]:  # orgs, people, locations
-            sanitized_text = sanitized_text.replace(ent.text, f"[{ent.label_}]")
+def _split_on_paragraphs(text: str, size: int) -> list:
+    """Cut text into pieces of at most `size` chars, preferring paragraph then line breaks."""
+    windows = []
+    start = 0
+    while len(text) - start > size:
+        end = start + size
+        cut = text.rfind("\n\n", start, end)
+        if cut > start:
+            cut += 2
+        else:
+            cut = text.rfind("\n", start, end)
+            cut = cut + 1 if cut > start else end
+        windows.append(text[start:cut])
+        start = cut
+    windows.append(text[start:])
+    return windows
 
-    return sanitized_text
+
+def _merge_spans(spans: list) -> list:
+    """
+    Resolve (start, end, label) spans given in priority order: a span is
+    dropped if it overlaps one kept before it. Returns kept spans by start.
+    """
+    starts = []
+    kept = []
+    for start, end, label in spans:
+        i = bisect.bisect_right(starts, start)
+        if (i and kept[i - 1][1] > start) or (i < len(kept) and kept[i][0] < end):
+            continue
+        starts.insert(i, start)
+        kept.insert(i, (start, end, label))
+    return kept
+
+
+def _splice(text: str, spans: list) -> str:
+    """Replace each (start, end, label) span of text, given sorted and disjoint, with [label]."""
+    parts = []
+    cursor = 0
+    for start, end, label in spans:
+        parts.append(text[cursor:start])
+        parts.append(f"[{label}]")
+        cursor = end
+    parts.append(text[cursor:])
+    return "".join(parts)
+
+
+def sanitize_texts(texts: List[str], n_process: Optional[int] = None) -> List[str]:
+    """
+    Removes or masks client-specific identifiers before vectorization.
+    Covers: Emails, URLs/domains, phone numbers, organizations, person names, and locations.
+    All texts share one nlp.pipe run, so many documents are sanitized at
+    spaCy's batched throughput. n_process defaults to SPACY_PROCESSES.
+    With LAZY_SPACY only the regex masks apply.
+    """
+    # Regex-based anonymization for structured identifiers
+    spans = [[(m.start(), m.end(), m.lastgroup) for m in _SANI_RE.finditer(text)] for text in texts]
+
+    if not LAZY_SPACY:
+        # NER over paragraph-aligned windows: keeps each Doc small and lets
+        # spaCy spread long (multi-file) texts over several processes
+        windows = []  # (text index, offset in text, window)
+        for i, text in enumerate(texts):
+            offset = 0
+            for window in _split_on_paragraphs(text, SPACY_WINDOW_CHARS):
+                windows.append((i, offset, window))
+                offset += len(window)
+        if SPACY_PREFER_GPU:
+            n_process = 1
+        else:
+            n_process = n_process or SPACY_PROCESSES
+            n_process = max(1, min(len(windows), n_process))
+        docs = _get_nlp().pipe((window for _, _, window in windows), batch_size=32, n_process=n_process)
+        for (i, offset, _), doc in zip(windows, docs):
+            spans[i].extend((offset + ent.start_char, offset + ent.end_char, ent.label_)
+                            for ent in doc.ents
+                            if ent.label_ in TARGET_LABELS)
+
+    # one pass over each text, splicing every kept span
+    return [_splice(text, _merge_spans(text_spans)) for text, text_spans in zip(texts, spans)]
+
+
+def sanitize_text(text: str) -> str:
+    """Single-text sanitize_texts."""
+    return sanitize_texts([text])[0]
 
 # ------------------------------------------------------------------
 
+@lru_cache(maxsize=1)
+def _get_local_embeddings(model_name: str):
+    """Load the sentence-transformers model once per process, on GPU if there is one."""
+    import torch
+    from langchain_community.embeddings import HuggingFaceEmbeddings
+    return HuggingFaceEmbeddings(
+        model_name=model_name,
+        model_kwargs={"device": "cuda" if torch.cuda.is_available() else "cpu"},
+        encode_kwargs={"batch_size": LOCAL_EMBED_BATCH_SIZE, "normalize_embeddings": True},
+    )
+
+
 def _get_embeddings(api_key: str):
-    return OpenAIEmbeddings(openai_api_key=api_key)
+    if EMBEDDINGS_BACKEND == "local":
+        return CachedEmbeddings(_get_local_embeddings(LOCAL_EMBED_MODEL), LOCAL_EMBED_MODEL)
+    embeddings = OpenAIEmbeddings(openai_api_key=api_key, chunk_size=EMBED_BATCH_SIZE,
+                                  max_retries=EMBED_MAX_RETRIES, request_timeout=EMBED_REQUEST_TIMEOUT)
+    return CachedEmbeddings(embeddings, embeddings.model, concurrency=EMBED_CONCURRENCY)
 
 
-def build_qa_engine(raw_text: str,
-                    openai_api_key: str,
-                    model_name: Optional[str] = DEFAULT_MODEL,
-                    chunk_size: int = CHUNK_SIZE,
-                    chunk_overlap: int = CHUNK_OVERLAP,
-                    cache_name: Optional[str] = None,
-                    load_vectorstore_obj=None) -> Tuple[RetrievalQA, Optional[FAISS]]:
+# ----------------------- EMBEDDING CACHE -----------------------
+_query_vectors: "OrderedDict[Tuple[str, str], Tuple[float, ...]]" = OrderedDict()
+_query_vectors_lock = threading.Lock()
+
+
+class CachedEmbeddings(Embeddings):
     """
-    Build or reuse a QA engine. Returns (qa_chain, vectorstore).
-    If load_vectorstore_obj is provided, that vectorstore is used directly.
-    If cache_name is provided, vectorstore saving/loading functions will use it.
+    Wraps an embeddings backend with a SQLite store of document vectors keyed
+    by sha256(model + chunk), so only chunks not seen before are embedded.
+    The store keeps the EMBED_CACHE_MAX_ROWS most recently used vectors.
+    The last QUERY_EMBED_CACHE_SIZE query vectors are kept in memory, shared
+    across instances, so one question is embedded once. `concurrency` is how
+    many EMBED_BATCH_SIZE batches _aembed_into_index keeps in flight.
     """
 
-    if load_vectorstore_obj:
-        vectorstore = load_vectorstore_obj
-    else:
-        if not raw_text:
-            raise ValueError("No raw_text provided to build new vectorstore.")
+    def __init__(self, embeddings: Embeddings, model_name: str, path: str = EMBED_CACHE_PATH,
+                 concurrency: int = 1):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.concurrency = concurrency
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS emb (key TEXT PRIMARY KEY, vec BLOB NOT NULL, "
+                         "last_used INTEGER NOT NULL DEFAULT 0)")
+            if "last_used" not in {row[1] for row in conn.execute("PRAGMA table_info(emb)")}:
+                # stores from before eviction; their rows count as least recently used
+                try:
+                    conn.execute("ALTER TABLE emb ADD COLUMN last_used INTEGER NOT NULL DEFAULT 0")
+                except sqlite3.OperationalError:
+                    pass  # another process added it first
+            conn.execute("CREATE INDEX IF NOT EXISTS emb_last_used ON emb (last_used)")
 
-        # 🔒 Step 1: Sanitize text before chunking and embedding
-        raw_text = sanitize_text(raw_text)
+    def _connect(self):
+        # a connection per call: the apps embed from worker threads
+        return sqlite3.connect(self.path, timeout=30)
 
-        # 🔹 Step 2: Chunk and embed sanitized text
-        splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-        chunks = splitter.split_text(raw_text)
-        embeddings = _get_embeddings(openai_api_key)
-        vectorstore = FAISS.from_texts(chunks, embeddings)
+    def _key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model_name}\0{text}".encode("utf-8")).hexdigest()
 
-    retriever = vectorstore.as_retriever(search_kwargs={"k": 6})
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self._key(t) for t in texts]
+        found = {}
+        now = int(time.time())
+        with closing(self._connect()) as conn:
+            unique = list(dict.fromkeys(keys))
+            for i in range(0, len(unique), EMBED_CACHE_SELECT_BATCH):
+                batch = unique[i:i + EMBED_CACHE_SELECT_BATCH]
+                placeholders = ",".join("?" * len(batch))
+                rows = conn.execute(f"SELECT key, vec FROM emb WHERE key IN ({placeholders})", batch)
+                found.update((k, np.frombuffer(v, dtype=np.float32).tolist()) for k, v in rows)
+                with conn:
+                    conn.execute(f"UPDATE emb SET last_used = ? WHERE key IN ({placeholders}) AND last_used < ?",
+                                 [now, *batch, now - EMBED_CACHE_TOUCH_INTERVAL])
 
-    llm = ChatOpenAI(model=model_name, temperature=0.3, openai_api_key=openai_api_key)
+            # embed each missing chunk once
+            misses = {}
+            for key, text in zip(keys, texts):
+                if key not in found:
+                    misses.setdefault(key, text)
+            if misses:
+                vectors = self.embeddings.embed_documents(list(misses.values()))
+                found.update(zip(misses, vectors))
+                with conn:
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO emb (key, vec, last_used) VALUES (?, ?, ?)",
+                        [(k, np.asarray(v, dtype=np.float32).tobytes(), now) for k, v in zip(misses, vectors)],
+                    )
+                self._evict(conn)
+        return [found[k] for k in keys]
 
-    prompt_template = """Use the following context to answer the question.
+    def _evict(self, conn):
+        # only inserts grow the store, so this runs after them rather than on every lookup
+        n_rows = conn.execute("SELECT COUNT(*) FROM emb").fetchone()[0]
+        if n_rows > EMBED_CACHE_MAX_ROWS:
+            with conn:
+                conn.execute("DELETE FROM emb WHERE key IN "
+                             "(SELECT key FROM emb ORDER BY last_used LIMIT ?)", (n_rows - EMBED_CACHE_MAX_ROWS,))
+
+    def embed_query(self, text: str) -> List[float]:
+        key = (self.model_name, text)
+        with _query_vectors_lock:
+            vector = _query_vectors.get(key)
+            if vector is not None:
+                _query_vectors.move_to_end(key)
+                return list(vector)
+        vector = self.embeddings.embed_query(text)
+        with _query_vectors_lock:
+            _query_vectors[key] = tuple(vector)
+            while len(_query_vectors) > QUERY_EMBED_CACHE_SIZE:
+                _query_vectors.popitem(last=False)
+        return vector
+
+
+# ----------------------- CHUNKING -----------------------
+@lru_cache(maxsize=4)
+def _get_splitter(chunk_size: int, chunk_overlap: int):
+    """
+    text -> chunks of at most chunk_size chars. Uses the native (Rust)
+    semantic-text-splitter when installed, LangChain's recursive splitter otherwise.
+    """
+    if _RustTextSplitter is not None:
+        return _RustTextSplitter(chunk_size, overlap=chunk_overlap).chunks
+    return RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap).split_text
+
+
+# ----------------------- VECTOR INDEX -----------------------
+def _ivf_nlist(n: int) -> int:
+    return max(16, int(4 * math.sqrt(n)))
+
+
+def _train_size(n: int) -> int:
+    """How many vectors the index _make_index picks for n chunks is trained on; 0 if it needs none."""
+    if n > IVF_MIN_CHUNKS:
+        # coarse cells, and the 256 centroids of each PQ sub-quantizer
+        return min(n, max(INDEX_TRAIN_SAMPLE, 39 * _ivf_nlist(n), 39 * 256))
+    return min(n, INDEX_TRAIN_SAMPLE) if FAISS_SQ8 else 0
+
+
+def _make_index(dim: int, n: int) -> faiss.Index:
+    """
+    Exhaustive L2 index for small corpora, an HNSW graph above HNSW_MIN_CHUNKS
+    and an IVF-PQ index above IVF_MIN_CHUNKS. With FAISS_SQ8 the flat and HNSW
+    vectors are 8-bit scalar quantized. Quantized/IVF indexes need training.
+    """
+    if n > IVF_MIN_CHUNKS:
+        # queries only scan the IVF_NPROBE nearest of nlist cells
+        nlist = _ivf_nlist(n)
+        quantizer = faiss.IndexFlatL2(dim)
+        if dim % IVF_PQ_M == 0:
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, IVF_PQ_M, 8)
+        else:
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist)
+        index.nprobe = IVF_NPROBE
+        # MMR retrieval reconstructs candidate vectors by id
+        index.make_direct_map()
+        return index
+    if n > HNSW_MIN_CHUNKS:
+        if FAISS_SQ8:
+            index = faiss.IndexHNSWSQ(dim, faiss.ScalarQuantizer.QT_8bit, HNSW_M)
+        else:
+            index = faiss.IndexHNSWFlat(dim, HNSW_M)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+        return index
+    if FAISS_SQ8:
+        return faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_L2)
+    return faiss.IndexFlatL2(dim)
+
+
+async def _aembed_into_index(chunks: List[str], embeddings: Embeddings) -> faiss.Index:
+    """
+    Embed chunks in EMBED_BATCH_SIZE batches and add each batch to the index
+    as it arrives, in chunk order. An index that needs training is first
+    trained on a random sample of _train_size chunks; those vectors land in
+    the embedding cache, so streaming them again costs no API call. Only the
+    sample and a window of in-flight batches are ever held as vectors.
+    """
+    n = len(chunks)
+    window = max(1, getattr(embeddings, "concurrency", 1))
+    index = None
+
+    n_train = _train_size(n)
+    if n_train:
+        sample_ids = sorted(random.Random(0).sample(range(n), n_train))
+        sample = np.asarray(await embeddings.aembed_documents([chunks[i] for i in sample_ids]), dtype="float32")
+        index = _make_index(sample.shape[1], n)
+        index.train(sample)
+        if n_train == n:
+            # the sample is the whole corpus, already in chunk order
+            index.add(sample)
+            return index
+        del sample
+
+    def add(vectors):
+        nonlocal index
+        batch = np.asarray(vectors, dtype="float32")
+        if index is None:
+            index = _make_index(batch.shape[1], n)
+        index.add(batch)
+
+    pending = deque()
+    for start in range(0, n, EMBED_BATCH_SIZE):
+        pending.append(asyncio.ensure_future(embeddings.aembed_documents(chunks[start:start + EMBED_BATCH_SIZE])))
+        if len(pending) >= window:
+            add(await pending.popleft())
+    while pending:
+        add(await pending.popleft())
+    return index
+
+
+def _build_vectorstore(chunks: List[str], embeddings: Embeddings) -> FAISS:
+    """Embed chunks and index them in the index picked by _make_index."""
+    if not chunks:
+        raise ValueError("No text chunks to index.")
+    index = asyncio.run(_aembed_into_index(chunks, embeddings))
+    # docstore ids follow index positions
+    ids = [str(i) for i in range(len(chunks))]
+    return FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=InMemoryDocstore({id_: Document(page_content=chunk) for id_, chunk in zip(ids, chunks)}),
+        index_to_docstore_id=dict(enumerate(ids)),
+    )
+
+
+# ----------------------- RETRIEVAL -----------------------
+@lru_cache(maxsize=None)
+def _get_encoding(model_name: Optional[str]):
+    try:
+        return tiktoken.encoding_for_model(model_name or "")
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+class TokenBudget(BaseDocumentTransformer):
+    """Keep retrieved documents, in order, while they fit in `max_tokens` tokens."""
+
+    def __init__(self, max_tokens: int, model_name: Optional[str] = None):
+        self.max_tokens = max_tokens
+        self.model_name = model_name
+
+    def transform_documents(self, documents: Sequence[Document], **kwargs) -> Sequence[Document]:
+        encoding = _get_encoding(self.model_name)
+        kept = []
+        used = 0
+        for doc in documents:
+            used += len(encoding.encode(doc.page_content))
+            if used > self.max_tokens:
+                break
+            kept.append(doc)
+        return kept
+
+
+@lru_cache(maxsize=1)
+def _get_http_client() -> httpx.Client:
+    """One keep-alive HTTP/2 pool for every chat model client in the process."""
+    return httpx.Client(http2=True, timeout=httpx.Timeout(120.0, connect=10.0))
+
+
+# parsed once at import and shared by every chain
+_PROMPT_TEMPLATE = """Use the following context to answer the question.
     You are a highly intelligent assistant that answers questions based on the provided context.
     Use the context to provide the **most relevant, informative, and complete** answer possible.
     - If the context partially contains the answer, infer the missing parts logically.
@@ -93,17 +528,75 @@ def build_qa_engine(raw_text: str,
 
     Question: {question}
     Answer:"""
+_PROMPT = PromptTemplate(template=_PROMPT_TEMPLATE, input_variables=["context", "question"])
 
-    PROMPT = PromptTemplate(template=prompt_template, input_variables=["context", "question"])
+
+@lru_cache(maxsize=CHAIN_CACHE_SIZE)
+def _build_chain(vectorstore: FAISS, model_name: Optional[str], openai_api_key: str,
+                 k: int = RETRIEVAL_K) -> RetrievalQA:
+    """RetrievalQA over vectorstore, built once per (vectorstore object, model, key, k)."""
+    # MMR picks k diverse chunks out of the fetch_k nearest; the pipeline then drops
+    # weak matches, caps the context at a token budget and puts the best chunks at the ends
+    retriever = ContextualCompressionRetriever(
+        base_compressor=DocumentCompressorPipeline(transformers=[
+            EmbeddingsFilter(embeddings=vectorstore.embeddings, similarity_threshold=RETRIEVAL_MIN_SIMILARITY),
+            TokenBudget(RETRIEVAL_TOKEN_BUDGET, model_name),
+            LongContextReorder(),
+        ]),
+        base_retriever=vectorstore.as_retriever(
+            search_type="mmr", search_kwargs={"k": k, "fetch_k": max(20, 3 * k), "lambda_mult": 0.5}
+        ),
+    )
+
+    # streaming lets callers render tokens as they arrive (on_llm_new_token)
+    llm = ChatOpenAI(model=model_name, temperature=0.3, streaming=True, openai_api_key=openai_api_key,
+                     http_client=_get_http_client())
 
     qa = RetrievalQA.from_chain_type(
         llm=llm,
         retriever=retriever,
         chain_type="stuff",
-        chain_type_kwargs={"prompt": PROMPT},
+        chain_type_kwargs={"prompt": _PROMPT},
         return_source_documents=True,
     )
+    return qa
+
 
+def build_qa_engine(raw_text: Union[str, List[str]],
+                    openai_api_key: str,
+                    model_name: Optional[str] = DEFAULT_MODEL,
+                    chunk_size: int = CHUNK_SIZE,
+                    chunk_overlap: int = CHUNK_OVERLAP,
+                    cache_name: Optional[str] = None,
+                    load_vectorstore_obj=None) -> Tuple[RetrievalQA, Optional[FAISS]]:
+    """
+    Build or reuse a QA engine. Returns (qa_chain, vectorstore).
+    raw_text is a single text or a list of documents.
+    If load_vectorstore_obj is provided, that vectorstore is used directly.
+    If cache_name is provided, vectorstore saving/loading functions will use it.
+    """
+
+    if load_vectorstore_obj:
+        vectorstore = load_vectorstore_obj
+    else:
+        if not raw_text:
+            raise ValueError("No raw_text provided to build new vectorstore.")
+
+        # 🔒 Step 1: Sanitize text before chunking and embedding
+        # (a list of documents is sanitized as one batch and chunked per document)
+        docs = sanitize_texts(raw_text if isinstance(raw_text, list) else [raw_text])
+
+        # 🔹 Step 2: Chunk and embed sanitized text
+        split_text = _get_splitter(chunk_size, chunk_overlap)
+        chunks = [chunk for doc in docs for chunk in split_text(doc)]
+        # folder loads repeat headers/footers/TOCs: embed and index each distinct chunk once
+        chunks = list(dict.fromkeys(chunks))
+        embeddings = _get_embeddings(openai_api_key)
+        vectorstore = _build_vectorstore(chunks, embeddings)
+
+    # chains are shared per (vectorstore, model, key); per-call state such as
+    # streaming callbacks is passed when the chain is run
+    qa = _build_chain(vectorstore, model_name, openai_api_key)
     return qa, vectorstore
 
 
@@ -113,6 +606,10 @@ def save_vectorstore(vectorstore: FAISS, persist_dir: str, cache_name: Optional[
     target = os.path.join(persist_dir, cache_name)
     os.makedirs(target, exist_ok=True)
     vectorstore.save_local(target)
+    # a query cache left in the directory answers for the previous contents
+    path = os.path.join(target, QUERY_CACHE_FILE)
+    if os.path.exists(path):
+        os.remove(path)
 
 
 def load_vectorstore(openai_api_key: str, persist_dir: str, cache_name: Optional[str] = None) -> Optional[FAISS]:
@@ -121,5 +618,143 @@ def load_vectorstore(openai_api_key: str, persist_dir: str, cache_name: Optional
     target = os.path.join(persist_dir, cache_name)
     if not os.path.isdir(target):
         return None
+    # keyed on the resolved dir and the index's mtime, so a cache rebuilt or
+    # relinked under the same name is read again
+    target = os.path.realpath(target)
+    mtime_ns = os.stat(os.path.join(target, "index.faiss")).st_mtime_ns
+    return _load_vectorstore_cached(openai_api_key, target, mtime_ns)
+
+
+@lru_cache(maxsize=VECTORSTORE_CACHE_SIZE)
+def _load_vectorstore_cached(openai_api_key: str, target: str, mtime_ns: int) -> FAISS:
+    """Load a persisted vectorstore once per process; later loads share the object."""
     embeddings = _get_embeddings(openai_api_key)
-    return FAISS.load_local(target, embeddings, allow_dangerous_deserialization=True)
+    if not FAISS_MMAP:
+        return FAISS.load_local(target, embeddings, allow_dangerous_deserialization=True)
+    # map the index file instead of reading it: pages are faulted in as searches touch them
+    index = faiss.read_index(os.path.join(target, "index.faiss"), _FAISS_MMAP_FLAGS)
+    with open(os.path.join(target, "index.pkl"), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    return FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=docstore,
+        index_to_docstore_id=index_to_docstore_id,
+    )
+
+
+# ----------------------- SEMANTIC QUERY CACHE -----------------------
+@contextmanager
+def _dir_lock(directory: str):
+    """Exclusive query cache lock for directory, across threads and processes, where fcntl exists."""
+    if fcntl is None:
+        yield
+        return
+    with open(os.path.join(directory, "qcache.lock"), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class QueryCache:
+    """
+    Answers cached per knowledge base, looked up by query embedding.
+    A question whose cosine similarity to an earlier one is at least
+    `threshold` gets the earlier answer back without a retriever/LLM call.
+    If persist_dir is given the cache is stored there as QUERY_CACHE_FILE,
+    which every session using that directory merges its new answers into.
+    """
+
+    def __init__(self, openai_api_key: str, persist_dir: Optional[str] = None,
+                 threshold: float = QUERY_CACHE_THRESHOLD, ttl: float = QUERY_CACHE_TTL):
+        self.embeddings = _get_embeddings(openai_api_key)
+        self.persist_dir = persist_dir
+        self.threshold = threshold
+        self.ttl = ttl
+        self.index = None
+        self.entries = []  # {"answer", "context", "created"}, aligned with index ids
+        self._unsaved = []  # (vector, entry) added since the last save
+        if persist_dir:
+            self._load()
+
+    def _embed(self, query: str) -> np.ndarray:
+        vec = np.asarray([self.embeddings.embed_query(query)], dtype="float32")
+        faiss.normalize_L2(vec)  # inner product on unit vectors == cosine
+        return vec
+
+    def _lookup(self, vec: np.ndarray) -> Optional[dict]:
+        if self.index is None or not self.index.ntotal:
+            return None
+        now = time.time()
+        scores, ids = self.index.search(vec, min(4, self.index.ntotal))
+        for score, i in zip(scores[0], ids[0]):
+            if i < 0 or score < self.threshold:
+                break
+            entry = self.entries[i]
+            if now - entry["created"] < self.ttl:
+                return entry
+        return None
+
+    def _append(self, vectors: np.ndarray, entries: list):
+        if self.index is None:
+            self.index = faiss.IndexFlatIP(vectors.shape[1])
+        self.index.add(vectors)
+        self.entries.extend(entries)
+
+    def _add(self, vec: np.ndarray, answer: str, context: list):
+        entry = {"answer": answer, "context": context, "created": time.time()}
+        self._append(vec, [entry])
+        if self.persist_dir:
+            self._unsaved.append((vec, entry))
+            self._save()
+
+    def ask(self, qa: RetrievalQA, query: str, callbacks: Optional[list] = None) -> dict:
+        """
+        Return a cached result for a near-duplicate query, else run `qa` and cache it.
+        `callbacks` are passed to the chain run, e.g. to stream tokens on a miss.
+        """
+        vec = self._embed(query)
+        entry = self._lookup(vec)
+        if entry is not None:
+            return {"query": query, "result": entry["answer"], "source_documents": entry["context"]}
+        result = qa({"query": query}, callbacks=callbacks)
+        self._add(vec, result["result"], result.get("source_documents", []))
+        return result
+
+    def _save(self):
+        os.makedirs(self.persist_dir, exist_ok=True)
+        with _dir_lock(self.persist_dir):
+            # start from what is on disk now, so answers other sessions saved are kept
+            self.index, self.entries = None, []
+            self._load()
+            for vec, entry in self._unsaved:
+                self._append(vec, [entry])
+            self._unsaved = []
+            # index and entries go in one file, replaced atomically, so they cannot disagree
+            state = {"vectors": self.index.reconstruct_n(0, self.index.ntotal), "entries": self.entries}
+            fd, tmp_path = tempfile.mkstemp(dir=self.persist_dir, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    pickle.dump(state, f)
+                os.replace(tmp_path, os.path.join(self.persist_dir, QUERY_CACHE_FILE))
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+
+    def _load(self):
+        try:
+            with open(os.path.join(self.persist_dir, QUERY_CACHE_FILE), "rb") as f:
+                state = pickle.load(f)
+            vectors = np.asarray(state["vectors"], dtype="float32")
+            entries = state["entries"]
+        except (OSError, EOFError, pickle.UnpicklingError, KeyError, TypeError, ValueError):
+            return
+        if len(entries) != len(vectors):
+            return
+        # drop expired entries so the cache does not grow without bound
+        now = time.time()
+        keep = [i for i, e in enumerate(entries) if now - e["created"] < self.ttl]
+        if keep:
+            self._append(vectors[keep], [entries[i] for i in keep])
@@ -1,5 +1,6 @@
 import os
 import re
+from functools import lru_cache
 from typing import Optional, Tuple
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_openai import ChatOpenAI, OpenAIEmbeddings
@@ -12,35 +13,56 @@ import spacy
 DEFAULT_MODEL = "gpt-4o"  # adjust to your available model
 CHUNK_SIZE = 1000
 CHUNK_OVERLAP = 100
+# only NER is used, so the other components are not loaded
+SPACY_EXCLUDED = ["parser", "tagger", "lemmatizer", "attribute_ruler", "senter"]
+# entity labels masked by NER: orgs, people, locations
+TARGET_LABELS = frozenset({"ORG", "PERSON", "GPE", "LOC"})
+# structured identifiers, compiled once and matched in one scan; the group name is the mask label
+_SANITIZER_RE = re.compile(
+    r"\b(?:"
+    r"(?P<EMAIL>[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,})"  # Emails
+    r"|(?P<DOMAIN>(?:https?://)?(?:www\.)?[A-Za-z0-9.-]+\.[A-Za-z]{2,})"  # Domains/URLs
+    r"|(?P<PHONE>\d{3,4}[- ]?\d{6,10})"  # Phone numbers
+    r")\b"
+)
+# run spaCy on the GPU when one is available (needs spacy[cuda])
+SPACY_PREFER_GPU = os.getenv("SPACY_PREFER_GPU") == "1"
 
 # ----------------------- SANITIZATION LOGIC -----------------------
+@lru_cache(maxsize=1)
+def _get_nlp():
+    """Load the lightweight spaCy model once per process."""
+    if SPACY_PREFER_GPU:
+        spacy.prefer_gpu()
+    try:
+        return spacy.load("en_core_web_sm", exclude=SPACY_EXCLUDED)
+    except OSError:
+        # fallback if model not downloaded
+        from spacy.cli import download
+        download("en_core_web_sm")
+        return spacy.load("en_core_web_sm", exclude=SPACY_EXCLUDED)
+
+
 def sanitize_text(text: str) -> str:
     """
     Removes or masks client-specific identifiers before vectorization.
     Covers: Emails, URLs/domains, phone numbers, organizations, person names, and locations.
     """
     # Regex-based anonymization for structured identifiers
-    text = re.sub(r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b', "[EMAIL]", text)  # Emails
-    text = re.sub(r'\b(?:https?://)?(?:www\.)?[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b', "[DOMAIN]", text)  # Domains/URLs
-    text = re.sub(r'\b\d{3,4}[- ]?\d{6,10}\b', "[PHONE]", text)  # Phone numbers
+    text = _SANITIZER_RE.sub(lambda m: f"[{m.lastgroup}]", text)
 
-    # Load lightweight spaCy model for entity detection
-    try:
-        nlp = spacy.load("en_core_web_sm")
-    except OSError:
-        # fallback if model not downloaded
-        from spacy.cli import download
-        download("en_core_web_sm")
-        nlp = spacy.load("en_core_web_sm")
-
-    doc = nlp(text)
-    sanitized_text = text
+    doc = _get_nlp()(text)
 
+    # rewrite by entity offsets in one pass (doc.ents are sorted and disjoint)
+    parts = []
+    cursor = 0
     for ent in doc.ents:
-        if ent.label_ in ["ORG", "PERSON", "GPE", "LOC"]:  # orgs, people, locations
-            sanitized_text = sanitized_text.replace(ent.text, f"[{ent.label_}]")
-
-    return sanitized_text
+        if ent.label_ in TARGET_LABELS:
+            parts.append(text[cursor:ent.start_char])
+            parts.append(f"[{ent.label_}]")
+            cursor = ent.end_char
+    parts.append(text[cursor:])
+    return "".join(parts)
 
 # ------------------------------------------------------------------
 